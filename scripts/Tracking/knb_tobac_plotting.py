@@ -42,6 +42,9 @@ def create_parser():
                         help='The longitude center for plotting')
     parser.add_argument('--dxy',metavar='xy grid spacing in km', required = False,
                         dest='dxy',action='store',type=float)
+    parser.add_argument('--nprocs', metavar='n', required=False, type=int,
+                        dest='nprocs', action='store', default=None,
+                        help='Number of processes used to render frames, default is all cores')
     return parser
 
 # End parsing #
@@ -54,11 +57,17 @@ import pandas as pd
 import os
 from six.moves import urllib
 from glob import glob
-import matplotlib.pyplot as plt
 import matplotlib as mpl
+# Frames are only written to file, possibly from several worker processes
+mpl.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import tempfile
+import shutil
 import pickle
 import pyart
-from datetime import datetime
 import math
 from pandas.core.common import flatten
 
@@ -70,6 +79,13 @@ try:
 except ImportError:
     _PYPROJ_AVAILABLE = False
 
+try:
+    import numba
+
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
 
 # get_ipython().run_line_magic("matplotlib", "inline")
 # %matplotlib widget
@@ -259,6 +275,42 @@ def compress_all(nc_grids, min_dims=2, comp_level=4):
     return nc_grids
 
 
+if _NUMBA_AVAILABLE:
+
+    @numba.njit(cache=True)
+    def _aeqd_kernel(x, y, lon_0_rad, lat_0_rad, R, lon_out, lat_out):
+        """
+        Fused loop over flat x, y arrays with the same math as
+        cartesian_to_geographic_aeqd, writing degrees into lon_out, lat_out.
+        """
+        sin_lat_0 = math.sin(lat_0_rad)
+        cos_lat_0 = math.cos(lat_0_rad)
+        for i in range(x.size):
+            rho = math.sqrt(x[i] * x[i] + y[i] * y[i])
+            if rho == 0.0:
+                lat_out[i] = math.degrees(lat_0_rad)
+                lon = math.degrees(lon_0_rad)
+            else:
+                c = rho / R
+                sin_c = math.sin(c)
+                cos_c = math.cos(c)
+                lat_out[i] = math.degrees(
+                    math.asin(cos_c * sin_lat_0 + y[i] * sin_c * cos_lat_0 / rho)
+                )
+                lon = math.degrees(
+                    lon_0_rad
+                    + math.atan2(
+                        x[i] * sin_c, rho * cos_lat_0 * cos_c - y[i] * sin_lat_0 * sin_c
+                    )
+                )
+            # Longitudes should be from -180 to 180 degrees
+            if lon > 180.0:
+                lon -= 360.0
+            elif lon < -180.0:
+                lon += 360.0
+            lon_out[i] = lon
+
+
 def cartesian_to_geographic_aeqd(x, y, lon_0, lat_0, R=6370997.0):
     """
     Azimuthal equidistant Cartesian to geographic coordinate transform.
@@ -313,6 +365,15 @@ def cartesian_to_geographic_aeqd(x, y, lon_0, lat_0, R=6370997.0):
     lat_0_rad = np.deg2rad(lat_0)
     lon_0_rad = np.deg2rad(lon_0)
 
+    if _NUMBA_AVAILABLE:
+        x, y = np.broadcast_arrays(x, y)
+        xf = np.ascontiguousarray(x, dtype=np.float64).ravel()
+        yf = np.ascontiguousarray(y, dtype=np.float64).ravel()
+        lon_deg = np.empty_like(xf)
+        lat_deg = np.empty_like(xf)
+        _aeqd_kernel(xf, yf, lon_0_rad, lat_0_rad, float(R), lon_deg, lat_deg)
+        return lon_deg.reshape(x.shape), lat_deg.reshape(x.shape)
+
     rho = np.sqrt(x * x + y * y)
     c = rho / R
 
@@ -331,9 +392,8 @@ def cartesian_to_geographic_aeqd(x, y, lon_0, lat_0, R=6370997.0):
     x2 = rho * np.cos(lat_0_rad) * np.cos(c) - y * np.sin(lat_0_rad) * np.sin(c)
     lon_rad = lon_0_rad + np.arctan2(x1, x2)
     lon_deg = np.rad2deg(lon_rad)
-    # Longitudes should be from -180 to 180 degrees
-    lon_deg[lon_deg > 180] -= 360.0
-    lon_deg[lon_deg < -180] += 360.0
+    # Longitudes should be from -180 to 180 degrees; one in-place pass
+    np.subtract(np.remainder(lon_deg + 180.0, 360.0), 180.0, out=lon_deg)
 
     return lon_deg, lat_deg
 
@@ -355,14 +415,14 @@ def cartesian_to_geographic(grid_ds):
     Returns
     -------
     lon, lat : array
-        Longitude and latitude of the Cartesian coordinates in degrees.
+        Longitude and latitude of the Cartesian coordinates in degrees, with
+        shape (y, x). The projection does not depend on z.
 
     """
     projparams = grid_ds.ProjectionCoordinateSystem
-    x = grid_ds.x.values
-    y = grid_ds.y.values
-    z = grid_ds.z.values
-    z, y, x = np.meshgrid(z, y, x, indexing="ij")
+    x = grid_ds.x.values[None, :]
+    y = grid_ds.y.values[:, None]
+    x, y = np.broadcast_arrays(x, y)
     if projparams.attrs["grid_mapping_name"] == "azimuthal_equidistant":
         # Use Py-ART's Azimuthal equidistance projection
         lat_0 = projparams.attrs["latitude_of_projection_origin"]
@@ -388,25 +448,21 @@ def cartesian_to_geographic(grid_ds):
 
 def add_lat_lon_grid(grid_ds):
     lon, lat = cartesian_to_geographic(grid_ds)
-    grid_ds["point_latitude"] = xr.DataArray(lat, dims=["z", "y", "x"])
-    grid_ds["point_latitude"].attrs["long_name"] = "Latitude"
-    grid_ds["point_latitude"].attrs["units"] = "degrees"
-    grid_ds["point_longitude"] = xr.DataArray(lon, dims=["z", "y", "x"])
-    grid_ds["point_longitude"].attrs["long_name"] = "Latitude"
-    grid_ds["point_longitude"].attrs["units"] = "degrees"
+    # Same lon, lat at every level; broadcast_to returns a view, not a copy
+    shape = (grid_ds.z.size,) + lon.shape
+    lon, lat = np.broadcast_to(lon, shape), np.broadcast_to(lat, shape)
+    grid_ds["point_latitude"] = xr.DataArray(
+        lat, dims=["z", "y", "x"], attrs={"long_name": "Latitude", "units": "degrees"}
+    )
+    grid_ds["point_longitude"] = xr.DataArray(
+        lon, dims=["z", "y", "x"], attrs={"long_name": "Longitude", "units": "degrees"}
+    )
     return grid_ds
 
 
 def parse_grid_datetime(my_ds):
-    year = my_ds["time"].dt.year
-    month = my_ds["time"].dt.month
-    day = my_ds["time"].dt.day
-    hour = my_ds["time"].dt.hour
-    minute = my_ds["time"].dt.minute
-    second = my_ds["time"].dt.second
-    return datetime(
-        year=year, month=month, day=day, hour=hour, minute=minute, second=second
-    )
+    # Whole seconds, as datetime(year, ..., second) was built before
+    return pd.Timestamp(my_ds["time"].values).floor("s").to_pydatetime()
 
 
 """ X-Array based TINT I/O module. """
@@ -417,11 +473,57 @@ import numpy as np
 import pyproj
 
 # from .grid_utils import add_lat_lon_grid
-from datetime import datetime
 
 
-def load_cfradial_grids(file_list):
-    ds = xr.open_mfdataset(file_list)
+def _masked_column_max(refl, rhv):
+    # Max over the z axis, skipping points with both rhv < 0.9 and refl < 10
+    # (and missing refl) in a single pass; all-skipped columns become NaN
+    skip = ((rhv < 0.9) & (refl < 10)) | np.isnan(refl)
+    col_max = np.where(skip, -np.inf, refl).max(axis=-3)
+    col_max[col_max == -np.inf] = np.nan
+    return col_max
+
+
+def column_max_reflectivity(refl, rhv):
+    """
+    Column maximum of refl, ignoring points where rhv < 0.9 and refl < 10.
+
+    Equivalent to refl.where(~((rhv < 0.9) & (refl < 10))).max(axis=1), but
+    computed in one pass per time block without the NaN-filled intermediate.
+
+    Parameters
+    ----------
+    refl, rhv : xarray.DataArray
+        Reflectivity and correlation coefficient with the same dims, in the
+        order (time, z, y, x); the dims may have any names.
+
+    Returns
+    -------
+    maxrefl : xarray.DataArray
+        Column maximum reflectivity, with the second (vertical) dim removed.
+
+    """
+    # Reduce over the second dim, as max(axis=1) does, whatever it is named.
+    # Core dims must each be one dask chunk, but files chunked on disk per
+    # level open with several chunks along z, so merge them per time block.
+    core_dims = list(refl.dims[1:])
+    if refl.chunks is not None:
+        refl = refl.chunk({d: -1 for d in core_dims})
+    if rhv.chunks is not None:
+        rhv = rhv.chunk({d: -1 for d in core_dims})
+    return xr.apply_ufunc(
+        _masked_column_max,
+        refl,
+        rhv,
+        input_core_dims=[core_dims, core_dims],
+        output_core_dims=[core_dims[1:]],
+        dask="parallelized",
+        output_dtypes=[refl.dtype],
+    )
+
+
+def load_cfradial_grids(ds):
+    # ds is the already opened dataset, so the files are not opened twice
     # Check for CF/Radial conventions
     if not ds.attrs["Conventions"] == "CF/Radial instrument_parameters":
         ds.close()
@@ -443,11 +545,18 @@ def load_cfradial_grids_polarris(ds_data):
 
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import cartopy
 from cartopy.io.shapereader import Reader
 from cartopy.feature import ShapelyFeature
 from cartopy.mpl.geoaxes import GeoAxes
 from mpl_toolkits.axes_grid1 import AxesGrid
+from matplotlib.collections import LineCollection
+
+# State boundaries are parsed from the shapefile once per process
+fname = "shapefiles/ne_10m_admin_1_states_provinces_lines.shp"
+#     fname = "ne_10m_admin_1_states_provinces_lines.shp"
+_STATES_FEATURE = ShapelyFeature(
+    list(Reader(fname).geometries()), ccrs.PlateCarree(), edgecolor="black", facecolor="none"
+)
 
 
 def time_in_range(start, end, x):
@@ -458,23 +567,154 @@ def time_in_range(start, end, x):
         return start <= x or x <= end
 
 
-def plot(t_index, xrdata, max_refl, ncgrid, grid_lat, grid_lon, ind=None):
-    # Get the data
+# Reflectivity color scale for the plots, and the uint8 level used for NaN
+REFL_VMIN, REFL_VMAX = -25, 85
+REFL_FILL = 255
+
+
+def quantize_reflectivity(refl, vmin=REFL_VMIN, vmax=REFL_VMAX):
+    """
+    Scale reflectivity in dBZ onto uint8 levels 0-254 spanning vmin to vmax.
+
+    Values outside the range are clipped and NaN becomes REFL_FILL. Used for
+    plotting only, where 255 color levels are more than the colormap resolves.
+
+    Parameters
+    ----------
+    refl : xarray.DataArray
+        Reflectivity in dBZ.
+
+    Returns
+    -------
+    refl_q : xarray.DataArray
+        uint8 copy of refl with the same dims and coordinates.
+
+    """
+    values = np.asarray(refl.values, dtype=np.float32)
+    q = np.clip(np.round((values - vmin) * (254.0 / (vmax - vmin))), 0, 254)
+    q[np.isnan(values)] = REFL_FILL
+    return refl.copy(data=q.astype(np.uint8))
+
+
+def add_cell_time_bounds(xrdata):
+    """
+    Add the first and last feature_time_index of each cell to xrdata as
+    cell_first_time_index and cell_last_time_index along the cell dimension.
+    Cells without any features are NaN.
+
+    Parameters
+    ----------
+    xrdata : xarray.core.dataset.Dataset
+        Combined track dataset, as written to Track_features_merges.nc
+
+    Returns
+    -------
+    xrdata : xarray.core.dataset.Dataset
+        The same dataset with the two new variables.
+
+    """
+    feat_df = pd.DataFrame(
+        {
+            "feature_parent_cell_id": xrdata["feature_parent_cell_id"].values,
+            "feature_time_index": xrdata["feature_time_index"].values,
+        }
+    ).dropna()
+    bounds = feat_df.groupby("feature_parent_cell_id")["feature_time_index"].agg(["min", "max"])
+    bounds = bounds.reindex(xrdata["cell"].values.astype(bounds.index.dtype))
+    xrdata["cell_first_time_index"] = ("cell", bounds["min"].values)
+    xrdata["cell_last_time_index"] = ("cell", bounds["max"].values)
+    return xrdata
+
+
+def group_features_by_cell(xrdata):
+    """
+    Group the features in xrdata by their parent cell.
+
+    Parameters
+    ----------
+    xrdata : xarray.core.dataset.Dataset
+        Combined track dataset, as written to Track_features_merges.nc
+
+    Returns
+    -------
+    cell_features : dict
+        For each cell id, a tuple of int32 arrays (hdim1, hdim2) giving the
+        nearest grid indices of the cell's features in time order.
+
+    """
+    cell_ids = xrdata["feature_parent_cell_id"].values
+    cell_indices = pd.Series(cell_ids).groupby(cell_ids).indices
+    # Round the feature centroids to grid indices once for all cells
+    h1i = np.round(xrdata["feature_hdim1_coordinate"].values).astype(np.int32)
+    h2i = np.round(xrdata["feature_hdim2_coordinate"].values).astype(np.int32)
+    return {cell: (h1i[idx], h2i[idx]) for cell, idx in cell_indices.items()}
+
+
+def wrf_cache_sources(files):
+    # Path and modification time of each wrfout file the cache is built from
+    return [f"{os.path.abspath(f)}:{os.path.getmtime(f)}" for f in sorted(files)]
+
+
+def open_wrf_cache(cache_path, files):
+    """
+    Open the Zarr cache of postprocessed wrfout data at cache_path.
+
+    Returns None if there is no cache, or if it was built from a different
+    set of files or from files that have been modified since.
+
+    """
+    if not os.path.exists(cache_path):
+        return None
+    data = xr.open_zarr(cache_path)
+    if data.attrs.get("source_files") != wrf_cache_sources(files):
+        data.close()
+        return None
+    return data
+
+
+def write_wrf_cache(data, cache_path, files):
+    """
+    Write data to a Zarr cache at cache_path, recording files as its sources,
+    and return the dataset opened from the cache.
+
+    The store is written under a temporary name and only renamed to
+    cache_path once complete, so a run that dies partway through never
+    leaves a partial cache for later runs to trust.
+
+    """
+    tmp_path = cache_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    data.assign_attrs(source_files=wrf_cache_sources(files)).to_zarr(tmp_path, mode="w")
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(tmp_path, cache_path)
+    return xr.open_zarr(cache_path)
+
+
+def setup_axes(ncgrid, grid_lat, grid_lon, figsize=(9, 9)):
+    """
+    Build the figure, map axes, static map features and reflectivity image once.
+
+    Each frame is then drawn with update_frame, which only replaces the
+    reflectivity data and the per-frame mask and track artists.
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+    axs : mpl_toolkits.axes_grid1.AxesGrid
+    im : matplotlib.image.AxesImage
+        Reflectivity image, updated in place by update_frame.
+    mask_im : matplotlib.image.AxesImage
+        Segmentation mask overlay, updated in place by update_frame.
+
+    """
     hsv_ctr_lat, hsv_ctr_lon = grid_lat, grid_lon #29.4719, -95.0792
    # hsv_ctr_lat, hsv_ctr_lon = 34.93055725, -86.08361053
     #     hsv_ctr_lat, hsv_ctr_lon = 33.89691544, -88.32919312
 
-    refl = max_refl[t_index, :, :]
-
-    t_step = str(ncgrid["time"][t_index].values)
-    nclons = ncgrid["point_longitude"][0, :, :].data
-    nclats = ncgrid["point_latitude"][0, :, :].data
-
-    fname = "shapefiles/ne_10m_admin_1_states_provinces_lines.shp"
-#     fname = "ne_10m_admin_1_states_provinces_lines.shp"
     # Plot
-    # fig.clear()
-    latlon_proj = ccrs.PlateCarree()
+    # Figures are built without pyplot, so none are kept in its registry
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
     cs_attrs = ncgrid["ProjectionCoordinateSystem"][0].attrs
     if cs_attrs["grid_mapping_name"] == "azimuthal_equidistant":
         grid_proj = ccrs.AzimuthalEquidistant(
@@ -499,9 +739,7 @@ def plot(t_index, xrdata, max_refl, ncgrid, grid_lat, grid_lon, ind=None):
     )  # note the empty label_mode
     for ax in axs:
         ax.coastlines()
-        shape_feature = ShapelyFeature(Reader(fname).geometries(), ccrs.PlateCarree(), edgecolor="black")
-        ax.add_feature(shape_feature, facecolor="none")
-        ax.add_feature(cartopy.feature.STATES, edgecolor="black")
+        ax.add_feature(_STATES_FEATURE)
         ax.set_extent(
             (hsv_ctr_lon - 2.5, hsv_ctr_lon + 2.5, hsv_ctr_lat - 3.0, hsv_ctr_lat + 2.5)
         )
@@ -515,107 +753,185 @@ def plot(t_index, xrdata, max_refl, ncgrid, grid_lat, grid_lon, ind=None):
 
     # fig.suptitle((t_step[0:19] + ' 40 dbz, long tracks, ISO_THRESH = 12'), fontsize = 12,y=0.76)
 
-    # Cell ID
+    # Cell ID; the data are replaced each frame by update_frame
+    # Data are the uint8 levels from quantize_reflectivity; the colorbar is
+    # labeled in dBZ
     im = axs[0].imshow(
-        refl,
+        np.ma.masked_all((ncgrid.y.size, ncgrid.x.size), dtype=np.uint8),
         origin="lower",
-        vmin=-25,
-        vmax=85,
+        vmin=0,
+        vmax=254,
         cmap="pyart_LangRainbow12",
         extent=grid_extent,
         transform=grid_proj,
     )
-    axs[0].set_title((t_step[0:19]))
-    axs.cbar_axes[0].colorbar(im)
-
-    i = np.where(xrdata["segmentation_mask"][t_index, :, :] > 0)
-    y1, x1 = (
-        ncgrid["point_longitude"].data[0, i[0], i[1]],
-        ncgrid["point_latitude"].data[0, i[0], i[1]],
-    )  
-
-    axs[0].scatter(y1, x1, s=1, c="gray", marker=".", alpha=0.1, transform=latlon_proj)
-
-    for i in xrdata["cell"]:
-        if i < 0:
-            continue
-
-        # print(i)
-        if math.isfinite(i):
-            track_i = np.where(xrdata["feature_parent_cell_id"] == i)
-            if (np.nanmax(xrdata["feature_time_index"][track_i]) >= t_index) and (
-                np.nanmin(xrdata["feature_time_index"][track_i]) <= t_index
-            ):
-                axs[0].plot(
-                    ncgrid["point_longitude"].data[
-                        0,
-                        np.round(
-                            xrdata["feature_hdim1_coordinate"].data[track_i]
-                        ).astype(int),
-                        np.round(
-                            xrdata["feature_hdim2_coordinate"].data[track_i]
-                        ).astype(int),
-                    ],
-                    ncgrid["point_latitude"].data[
-                        0,
-                        np.round(
-                            xrdata["feature_hdim1_coordinate"].data[track_i]
-                        ).astype(int),
-                        np.round(
-                            xrdata["feature_hdim2_coordinate"].data[track_i]
-                        ).astype(int),
-                    ],
-                    "-.",
-                    color="r",
-                    markersize=1,
-                    transform=latlon_proj,
-                )
-                axs[0].text(
-                    ncgrid["point_longitude"].data[
-                        0,
-                        np.round(
-                            both_ds["feature_hdim1_coordinate"].data[track_i][-1]
-                        ).astype(int),
-                        np.round(
-                            both_ds["feature_hdim2_coordinate"].data[track_i][-1]
-                        ).astype(int),
-                    ],
-                    ncgrid["point_latitude"].data[
-                        0,
-                        np.round(
-                            both_ds["feature_hdim1_coordinate"].data[track_i][-1]
-                        ).astype(int),
-                        np.round(
-                            both_ds["feature_hdim2_coordinate"].data[track_i][-1]
-                        ).astype(int),
-                    ],
-                    f"{int(i)}",
-                    fontsize="medium",
-                    rotation="vertical",
-                    transform=latlon_proj,
-                )
-        else:
-            continue
+    cbar = axs.cbar_axes[0].colorbar(im)
+    dbz_ticks = np.arange(-20, REFL_VMAX + 1, 10)
+    cbar.set_ticks((dbz_ticks - REFL_VMIN) * (254.0 / (REFL_VMAX - REFL_VMIN)))
+    cbar.set_ticklabels([str(t) for t in dbz_ticks])
+
+    # Segmented area as a single gray raster, NaN outside the mask
+    mask_im = axs[0].imshow(
+        np.full((ncgrid.y.size, ncgrid.x.size), np.nan),
+        origin="lower",
+        cmap=mpl.colors.ListedColormap(["gray"]),
+        alpha=0.1,
+        interpolation="nearest",
+        extent=grid_extent,
+        transform=grid_proj,
+    )
+
+    return fig, axs, im, mask_im
+
+
+def update_frame(t_index, axs, im, mask_im, xrdata, max_refl, ncgrid, cell_features=None, frame_artists=None):
+    """
+    Draw time t_index onto axes prepared by setup_axes.
+
+    max_refl holds the uint8 levels from quantize_reflectivity.
+    xrdata should carry the cell time bounds from add_cell_time_bounds and
+    cell_features is the result of group_features_by_cell; both are computed
+    here if missing. Artists in frame_artists, as returned by the previous
+    call, are removed first. Returns the list of artists added for this frame.
+
+    """
+    if frame_artists is not None:
+        for artist in frame_artists:
+            artist.remove()
+    frame_artists = []
+
+    # Local names for what the cell and track loops call repeatedly
+    ax = axs[0]
+    add_text = ax.text
+    column_stack = np.column_stack
+    # Features are on the grid, so their projected positions are just the grid
+    # x, y coordinates; drawing in the axes projection skips any reprojection
+    grid_proj = ax.projection
+    grid_x = np.asarray(ncgrid["x"].values)
+    grid_y = np.asarray(ncgrid["y"].values)
+    seg_mask = np.asarray(xrdata["segmentation_mask"][t_index, :, :].values)
+
+    im.set_data(np.ma.masked_equal(np.asarray(max_refl[t_index, :, :]), REFL_FILL))
+    t_step = str(ncgrid["time"][t_index].values)
+    ax.set_title((t_step[0:19]))
+
+    mask_im.set_data(np.where(seg_mask > 0, 1.0, np.nan))
+
+    # Only cells whose lifetime spans this frame are drawn
+    if "cell_first_time_index" not in xrdata:
+        xrdata = add_cell_time_bounds(xrdata)
+    if cell_features is None:
+        cell_features = group_features_by_cell(xrdata)
+    cells = xrdata["cell"].values
+    cell_tmin = xrdata["cell_first_time_index"].values
+    cell_tmax = xrdata["cell_last_time_index"].values
+    active = (cells >= 0) & (cell_tmin <= t_index) & (cell_tmax >= t_index)
+    active_cells = cells[active]
+    active_tracks = xrdata["cell_parent_track_id"].values[active]
+
+    cell_segments = []
+    for i in active_cells:
+        h1, h2 = cell_features[i]
+        px = grid_x[h2]
+        py = grid_y[h1]
+        cell_segments.append(column_stack((px, py)))
+        frame_artists.append(add_text(
+            px[-1],
+            py[-1],
+            f"{int(i)}",
+            fontsize="medium",
+            rotation="vertical",
+            transform=grid_proj,
+        ))
+    # One collection for all cell paths instead of one Line2D per cell
+    cell_lines = LineCollection(
+        cell_segments, colors="r", linestyles="-.", linewidths=1, transform=grid_proj
+    )
+    ax.add_collection(cell_lines)
+    frame_artists.append(cell_lines)
+
+    # The same active cells again, labeled with their parent track
+    in_track = np.isin(active_tracks, xrdata["track"].values)
+    track_segments = []
+    for cell, i in zip(active_cells[in_track], active_tracks[in_track]):
+        h1, h2 = cell_features[cell]
+        px = grid_x[h2]
+        py = grid_y[h1]
+        track_segments.append(column_stack((px, py)))
+        frame_artists.append(add_text(px[-1], py[-1],
+                    f'{int(i)}', fontsize = 'small',rotation = 'vertical',transform = grid_proj))
+    track_lines = LineCollection(
+        track_segments, colors="b", linestyles="-.", linewidths=1, transform=grid_proj
+    )
+    ax.add_collection(track_lines)
+    frame_artists.append(track_lines)
+
+    return frame_artists
 
-    for i in xrdata['track']:
-        track_i = np.where(xrdata['cell_parent_track_id'] == i.values)
-        for cell in xrdata['cell'][track_i]:
-            if cell < 0:
-                continue
-    
-            feature_id = np.where(xrdata['feature_parent_cell_id'] == cell)
-            if (np.nanmax(xrdata['feature_time_index'][feature_id]) >= t_index) and (np.nanmin(xrdata['feature_time_index'][feature_id]) <= t_index):
-                axs[0].plot(ncgrid['point_longitude'].data[0,np.round(xrdata['feature_hdim1_coordinate'].data[feature_id]).astype(int),np.round(xrdata['feature_hdim2_coordinate'].data[feature_id]).astype(int)],
-                            ncgrid['point_latitude'].data[0,np.round(xrdata['feature_hdim1_coordinate'].data[feature_id]).astype(int),np.round(xrdata['feature_hdim2_coordinate'].data[feature_id]).astype(int)],
-                            '-.',color = 'b',markersize = 1,transform = latlon_proj)
-    
-                axs[0].text(ncgrid['point_longitude'].data[0,np.round(both_ds['feature_hdim1_coordinate'].data[feature_id][-1]).astype(int),np.round(both_ds['feature_hdim2_coordinate'].data[feature_id][-1]).astype(int)],
-                            ncgrid['point_latitude'].data[0,np.round(both_ds['feature_hdim1_coordinate'].data[feature_id][-1]).astype(int),np.round(both_ds['feature_hdim2_coordinate'].data[feature_id][-1]).astype(int)],
-                            f'{int(i)}', fontsize = 'small',rotation = 'vertical',transform = latlon_proj)
-            else:
-                continue
 
-    return
+def render_frames(t_indices, xrdata, max_refl_path, ncgrid, grid_lat, grid_lon, cell_features, png_prefix):
+    """
+    Render and save the frames in t_indices using a single figure.
+
+    Files are named png_prefix + str(t_index) + ".png". Run in a worker
+    process by render_all_frames, so all arguments must be picklable;
+    max_refl_path is a .npy file of quantized reflectivity that is memory
+    mapped rather than sent to each worker.
+
+    """
+    max_refl = np.load(max_refl_path, mmap_mode="r")
+    fig, axs, im, mask_im = setup_axes(ncgrid, grid_lat, grid_lon)
+    frame_artists = None
+    for t_index in t_indices:
+        frame_artists = update_frame(t_index, axs, im, mask_im, xrdata, max_refl, ncgrid,
+                                     cell_features=cell_features, frame_artists=frame_artists)
+        fig.savefig(png_prefix + str(t_index) + ".png")
+    del fig
+
+
+def plot_grid_info(ncgrid):
+    """
+    Small copy of ncgrid with only what setup_axes and update_frame use: the
+    x, y and time coordinates and the ProjectionCoordinateSystem attributes.
+
+    Pickling the full grid for each worker would send the 4-D fields and turn
+    the broadcast point_latitude and point_longitude views into full copies.
+
+    """
+    pcs = ncgrid["ProjectionCoordinateSystem"]
+    return xr.Dataset(
+        {"ProjectionCoordinateSystem": (pcs.dims, np.asarray(pcs.values), pcs.attrs)},
+        coords={c: (c, ncgrid[c].values, ncgrid[c].attrs) for c in ("time", "y", "x")},
+    )
+
+
+def render_all_frames(xrdata, max_refl, ncgrid, grid_lat, grid_lon, png_prefix, nprocs=None):
+    """
+    Render every time in ncgrid, splitting the frames into one contiguous block
+    per process so that each worker sets up its axes only once.
+
+    """
+    nprocs = nprocs or os.cpu_count()
+    xrdata = add_cell_time_bounds(xrdata)
+    cell_features = group_features_by_cell(xrdata)
+    ncgrid = plot_grid_info(ncgrid)
+    blocks = [b for b in np.array_split(np.arange(len(ncgrid.time)), nprocs) if b.size > 0]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Workers memory map the quantized reflectivity instead of each
+        # receiving a pickled copy
+        max_refl_path = os.path.join(tmpdir, "max_refl.npy")
+        np.save(max_refl_path, quantize_reflectivity(max_refl).values)
+        # Spawn fresh workers instead of forking a parent that already runs
+        # dask and numba threads, which can leave the forked children hung
+        with ProcessPoolExecutor(max_workers=nprocs,
+                                 mp_context=multiprocessing.get_context("spawn")) as ex:
+            futures = [
+                ex.submit(render_frames, block, xrdata, max_refl_path, ncgrid,
+                          grid_lat, grid_lon, cell_features, png_prefix)
+                for block in blocks
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == '__main__':
@@ -632,26 +948,19 @@ if __name__ == '__main__':
     if args.data_type == 'NEXRAD':
         print('plotting')
         
-        data = xr.open_mfdataset(args.path+"*.nc", engine="netcdf4")
+        data = xr.open_mfdataset(args.path+"*.nc", engine="netcdf4", parallel=True, chunks={"time": 1})
         data['time'].encoding['units']="seconds since 2000-01-01 00:00:00"
-        bad_rhv = data["cross_correlation_ratio"] < 0.9
-        bad_refl = data["reflectivity"] < 10
-        bad=bad_rhv & bad_refl
-        maxrefl = data["reflectivity"].where(~bad, np.nan).max(axis=1)
+        # Reduce once up front so each frame is a slice of an in-memory array
+        maxrefl = column_max_reflectivity(data["reflectivity"], data["cross_correlation_ratio"]).compute()
         ts = pd.to_datetime(data['time'][0].values)
         date = ts.strftime('%Y%m%d')
 
         date = args.path[-9:-1]
         
         
-        nc_grid = load_cfradial_grids(args.path+"*.nc")
-        for i in range(len(nc_grid.time)):
-            time_index = i
-            fig = plt.figure(figsize=(9, 9))
-            fig.set_canvas(plt.gcf().canvas)
-            plot(time_index, both_ds, maxrefl, nc_grid,args.plot_lat, args.plot_lon)
-            fig.savefig(plot_dir + date+"_tobac_"+ str(time_index) +".png")
-            plt.close(fig)
+        nc_grid = load_cfradial_grids(data)
+        render_all_frames(both_ds, maxrefl, nc_grid, args.plot_lat, args.plot_lon,
+                          plot_dir + date+"_tobac_", nprocs=args.nprocs)
 
     if args.data_type == 'NUWRF':
     
@@ -662,10 +971,15 @@ if __name__ == '__main__':
 
 
 
-        import xwrf
-        data = xr.open_mfdataset(files, engine="netcdf4",parallel=True,
-            concat_dim="Time", combine="nested", chunks={"Time": 1},decode_times=False,
-            drop_variables=drop_list,).xwrf.postprocess()
+        # Reuse the postprocessed reflectivity from an earlier run if present
+        cache_path = os.path.join(args.tobacpath, "wrfout_postproc.zarr")
+        data = open_wrf_cache(cache_path, files)
+        if data is None:
+            import xwrf
+            data = xr.open_mfdataset(files, engine="netcdf4",parallel=True,
+                concat_dim="Time", combine="nested", chunks={"Time": 1},decode_times=False,
+                drop_variables=drop_list,).xwrf.postprocess()
+            data = write_wrf_cache(data[["COMDBZ", "XLAT", "XLONG"]], cache_path, files)
 
 
         #MAKE THE TIME DIMENSION AND COORDINATES PLAY NICE
@@ -680,7 +994,9 @@ if __name__ == '__main__':
         for j in range(len(maxrefl.time)):
             date = str(maxrefl['time'][j].values)[:-13]
             time_index = j
-            fig, ax = plt.subplots(figsize=(10,10))
+            fig = Figure(figsize=(10,10))
+            FigureCanvasAgg(fig)
+            ax = fig.subplots()
             refl = maxrefl[j,:,:].values
             fig.suptitle(str(maxrefl['time'][j].data)[:-10])
 
@@ -708,7 +1024,6 @@ if __name__ == '__main__':
                         continue
 
                 fig.savefig(plot_dir + date+"_tobac_NUWRF_"+str(time_index) + ".png")
-                plt.close(fig)
                 
                 
     if args.data_type == 'POLARRIS':
@@ -717,36 +1032,22 @@ if __name__ == '__main__':
         data = xr.open_mfdataset(args.path+'*.nc', engine = 'netcdf4',combine = 'nested' ,concat_dim='time')
         data['time'].encoding['units']="seconds since 2000-01-01 00:00:00"
         files = sorted(glob(args.path+'*.nc'))
-        arr = []
-        for i in files:
-            arr.append(pd.to_datetime(i[-19:-3], format = '%Y_%m%d_%H%M%S'))
-        arr = pd.DatetimeIndex(arr)
+        arr = pd.to_datetime([os.path.basename(f)[-19:-3] for f in files], format = '%Y_%m%d_%H%M%S')
         data = data.assign_coords(time=arr)
 
 
-        bad_rhv = data["RH"] < 0.9
-        bad_refl = data["CZ"] < 10
-        bad=bad_rhv & bad_refl
-        maxrefl = data["CZ"].where(~bad, np.nan).max(axis=1)
+        maxrefl = column_max_reflectivity(data["CZ"], data["RH"]).compute()
 
         nc_grid = load_cfradial_grids_polarris(data)
-        for i in range(len(nc_grid.time)):
-            time_index = i
-            fig = plt.figure(figsize=(9,9))
-            fig.set_canvas(plt.gcf().canvas)
-            plot(time_index,both_ds,maxrefl,nc_grid,args.plot_lat, args.plot_lon)
-            fig.savefig(plot_dir + date+"_tobac_NUWRF_"+str(time_index)+".png")
-            plt.close(fig)
+        render_all_frames(both_ds, maxrefl, nc_grid, args.plot_lat, args.plot_lon,
+                          plot_dir + date+"_tobac_NUWRF_", nprocs=args.nprocs)
 
     if args.data_type == 'POLARRIS2':
         import numpy.ma as ma
         data = xr.open_mfdataset(args.path + "*POLARRIS.matsui2018.nc", engine="netcdf4", combine="nested", concat_dim="time")
         data["time"].encoding["units"] = "seconds since 2000-01-01 00:00:00"
         files = sorted(glob(args.path + "*POLARRIS.matsui2018.nc"))
-        arr = []
-        for i in files:
-            arr.append(pd.to_datetime(i[-42:-23], format="%Y-%m-%d_%H:%M:%S"))
-        arr = pd.DatetimeIndex(arr)
+        arr = pd.to_datetime([os.path.basename(f)[-42:-23] for f in files], format="%Y-%m-%d_%H:%M:%S")
         data = data.assign_coords(time=arr)
 
         bad_rhv = data["rhohv01"] < 0.9
@@ -769,7 +1070,9 @@ if __name__ == '__main__':
 
         ref_levels = [5,10,15,20,25,30,35,40,45,50,55,60,65,70,75]
         for j in range(len(maxrefl.time)):
-            fig, ax = plt.subplots(figsize=(10,10))
+            fig = Figure(figsize=(10,10))
+            FigureCanvasAgg(fig)
+            ax = fig.subplots()
             date = str(maxrefl['time'][j].values)[:-13]
             time_index = j
             refl = maxrefl[j,:,:].values
@@ -800,5 +1103,5 @@ if __name__ == '__main__':
                         continue
 
             fig.savefig(plot_dir + date+"_tobac_POLARRIS_"+str(time_index) + ".png")
-            plt.close(fig)
+            del fig
          
\ No newline at end of file
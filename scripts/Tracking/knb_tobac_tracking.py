@@ -56,6 +56,7 @@ import xarray
 import xarray as xr
 import numpy as np
 import pandas as pd
+import dask
 import os
 from six.moves import urllib
 from glob import glob
@@ -67,7 +68,7 @@ from datetime import datetime
 import math
 from pandas.core.common import flatten
 from scipy import ndimage
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree as KDTree
 
 # get_ipython().run_line_magic("matplotlib", "inline")
 # %matplotlib widget
@@ -285,27 +286,39 @@ def cartesian_to_geographic_aeqd(x, y, lon_0, lat_0, R=6370997.0):
     lat_0_rad = np.deg2rad(lat_0)
     lon_0_rad = np.deg2rad(lon_0)
 
-    rho = np.sqrt(x * x + y * y)
+    # Reuse buffers with out= and in-place operators; these grids can be large
+    rho = np.hypot(x, y)
     c = rho / R
+    sin_c = np.sin(c)
+    cos_c = np.cos(c, out=c)
+    sin_lat_0 = np.sin(lat_0_rad)
+    cos_lat_0 = np.cos(lat_0_rad)
 
     with warnings.catch_warnings():
         # division by zero may occur here but is properly addressed below so
         # the warnings can be ignored
         warnings.simplefilter("ignore", RuntimeWarning)
-        lat_rad = np.arcsin(
-            np.cos(c) * np.sin(lat_0_rad) + y * np.sin(c) * np.cos(lat_0_rad) / rho
-        )
-    lat_deg = np.rad2deg(lat_rad)
+        lat_deg = y * sin_c
+        lat_deg *= cos_lat_0
+        lat_deg /= rho
+        lat_deg += sin_lat_0 * cos_c
+        np.arcsin(lat_deg, out=lat_deg)
+    np.rad2deg(lat_deg, out=lat_deg)
     # fix cases where the distance from the center of the projection is zero
     lat_deg[rho == 0] = lat_0
 
-    x1 = x * np.sin(c)
-    x2 = rho * np.cos(lat_0_rad) * np.cos(c) - y * np.sin(lat_0_rad) * np.sin(c)
-    lon_rad = lon_0_rad + np.arctan2(x1, x2)
-    lon_deg = np.rad2deg(lon_rad)
-    # Longitudes should be from -180 to 180 degrees
-    lon_deg[lon_deg > 180] -= 360.0
-    lon_deg[lon_deg < -180] += 360.0
+    x1 = x * sin_c
+    sin_c *= y
+    sin_c *= sin_lat_0
+    x2 = rho
+    x2 *= cos_lat_0
+    x2 *= cos_c
+    x2 -= sin_c
+    lon_deg = np.arctan2(x1, x2, out=x1)
+    lon_deg += lon_0_rad
+    np.rad2deg(lon_deg, out=lon_deg)
+    # Longitudes should be from -180 to 180 degrees; one in-place pass
+    np.subtract(np.remainder(lon_deg + 180.0, 360.0), 180.0, out=lon_deg)
 
     return lon_deg, lat_deg
 
@@ -327,14 +340,14 @@ def cartesian_to_geographic(grid_ds):
     Returns
     -------
     lon, lat : array
-        Longitude and latitude of the Cartesian coordinates in degrees.
+        Longitude and latitude of the Cartesian coordinates in degrees, with
+        shape (y, x). The projection does not depend on z.
 
     """
     projparams = grid_ds.ProjectionCoordinateSystem
-    x = grid_ds.x.values
-    y = grid_ds.y.values
-    z = grid_ds.z.values
-    z, y, x = np.meshgrid(z, y, x, indexing="ij")
+    x = grid_ds.x.values[None, :]
+    y = grid_ds.y.values[:, None]
+    x, y = np.broadcast_arrays(x, y)
     if projparams.attrs["grid_mapping_name"] == "azimuthal_equidistant":
         # Use Py-ART's Azimuthal equidistance projection
         lat_0 = projparams.attrs["latitude_of_projection_origin"]
@@ -360,12 +373,15 @@ def cartesian_to_geographic(grid_ds):
 
 def add_lat_lon_grid(grid_ds):
     lon, lat = cartesian_to_geographic(grid_ds)
-    grid_ds["point_latitude"] = xr.DataArray(lat, dims=["z", "y", "x"])
-    grid_ds["point_latitude"].attrs["long_name"] = "Latitude"
-    grid_ds["point_latitude"].attrs["units"] = "degrees"
-    grid_ds["point_longitude"] = xr.DataArray(lon, dims=["z", "y", "x"])
-    grid_ds["point_longitude"].attrs["long_name"] = "Latitude"
-    grid_ds["point_longitude"].attrs["units"] = "degrees"
+    # Same lon, lat at every level; broadcast_to returns a view, not a copy
+    shape = (grid_ds.z.size,) + lon.shape
+    lon, lat = np.broadcast_to(lon, shape), np.broadcast_to(lat, shape)
+    grid_ds["point_latitude"] = xr.DataArray(
+        lat, dims=["z", "y", "x"], attrs={"long_name": "Latitude", "units": "degrees"}
+    )
+    grid_ds["point_longitude"] = xr.DataArray(
+        lon, dims=["z", "y", "x"], attrs={"long_name": "Longitude", "units": "degrees"}
+    )
     return grid_ds
 
 
@@ -380,40 +396,142 @@ def parse_grid_datetime(my_ds):
         year=year, month=month, day=day, hour=hour, minute=minute, second=second
     )
 
-def count_track_neighbors(track_ds, distance_thresholds = (5.0, 10.0, 15.0, 20.0), grid_spacing = 0.5):
-    from scipy.spatial import KDTree
-
+def count_track_neighbors(track_ds, *, distance_thresholds = (5.0, 10.0, 15.0, 20.0), grid_spacing = 0.5):
     feature_neighbor_variable_names = []
 
-    # First find the trees corresponding to all features at each time.
-    time_groups = track_ds.groupby('feature_time_index')
-    time_groups.groups.keys()
-    trees_each_time_index = {}
-    for time_idx, group in time_groups:
-        hdim1 = group['feature_hdim1_coordinate'].values*grid_spacing
-        hdim2 = group['feature_hdim2_coordinate'].values*grid_spacing
-        #note hdim1,2 are in km
-        pts = np.vstack((hdim2, hdim1)).T
-        tree = KDTree(pts)
-        trees_each_time_index[time_idx] = tree
-
-    # Now we'll look at each feature in turn, and its neighbors at that time.
     hdim1 = track_ds['feature_hdim1_coordinate'].values*grid_spacing
     hdim2 = track_ds['feature_hdim2_coordinate'].values*grid_spacing
-    pts = np.vstack((hdim2, hdim1)).T
     #note hdim1,2 are in km
-    for distance_threshold in distance_thresholds:
-        num_obj = np.zeros(len(track_ds["feature"].values), dtype=int)
-        for i, ind in enumerate(track_ds["feature"].values):
-            time_idx = track_ds.feature_time_index.values[i]
-            tree = trees_each_time_index[time_idx]
-            # Need to subtract one, since the feature itself is always near (at) the test location
-            num_obj[i]=len(tree.query_ball_point(pts[i],r=distance_threshold)) - 1 
+    pts = np.column_stack((hdim2, hdim1))
+
+    # Group the features (positions along the feature dimension) by time.
+    feature_time_index = track_ds.feature_time_index.values
+    time_to_indices = {time_idx: np.where(feature_time_index == time_idx)[0]
+                       for time_idx in np.unique(feature_time_index)}
+
+    # The thresholds are nested, so find all pairs of features within the
+    # largest one at each time, put each pair in the smallest threshold that
+    # contains it, and accumulate the counts up through the larger thresholds.
+    thresholds = np.asarray(distance_thresholds, dtype=float)
+    order = np.argsort(thresholds)
+    # Compare squared distances, as the tree does, so the bounds are inclusive
+    sorted_sq_thresholds = thresholds[order]**2
+    nthresh = len(thresholds)
+    def time_group_counts(idx):
+        tree = KDTree(pts[idx])
+        pairs = tree.query_pairs(r=thresholds.max(), output_type='ndarray')
+        sq_dist = ((tree.data[pairs[:, 0]] - tree.data[pairs[:, 1]])**2).sum(axis=1)
+        bins = np.searchsorted(sorted_sq_thresholds, sq_dist)
+        # Each pair is a neighbor of both of its features
+        n = len(idx)
+        counts = np.bincount(np.concatenate((bins*n + pairs[:, 0], bins*n + pairs[:, 1])),
+                             minlength=nthresh*n).reshape(nthresh, n)
+        return np.cumsum(counts, axis=0)
+
+    # The times are independent, and cKDTree and NumPy release the GIL, so
+    # the groups run on dask's thread pool
+    groups = list(time_to_indices.values())
+    group_counts = dask.compute(*[dask.delayed(time_group_counts)(idx) for idx in groups],
+                                scheduler="threads")
+    num_obj = np.zeros((nthresh, len(pts)), dtype=int)
+    for idx, counts in zip(groups, group_counts):
+        num_obj[order[:, None], idx[None, :]] = counts
+
+    nearby_vars = {}
+    for k, distance_threshold in enumerate(distance_thresholds):
         this_nearby_var_name = 'feature_nearby_count_{0}km'.format(int(distance_threshold))
         feature_neighbor_variable_names.append(this_nearby_var_name)
-        track_ds = track_ds.assign(**{this_nearby_var_name:(['feature'], num_obj)})
+        nearby_vars[this_nearby_var_name] = (['feature'], num_obj[k])
+    # One assign, rather than a new Dataset per threshold
+    track_ds = track_ds.assign(**nearby_vars)
     return track_ds
 
+def feature_area_and_max(mask, values, nlabels):
+    """
+    Grid cell count and maximum of values for every label of a time series of
+    segmentation masks.
+
+    Frames are read one at a time, and each frame's np.bincount and
+    np.fmax.at accumulate straight into a single label-sized array per
+    statistic, so no temporary is larger than one frame.
+
+    Parameters
+    ----------
+    mask : xarray.DataArray
+        Integer segmentation mask with dims (time, y, x) in that order; labels
+        are the feature numbers, unique across all times.
+    values : xarray.DataArray
+        Field with the same shape as mask; NaNs are ignored in the maximum.
+    nlabels : int
+        Length of the output arrays, larger than the largest label.
+
+    Returns
+    -------
+    areas, maxima : numpy.ndarray
+        Indexed by label. Labels that never occur in mask have an area and
+        maximum of 0; the maximum is NaN if all values of a label are NaN.
+
+    """
+    areas = np.zeros(nlabels)
+    maxima = np.full(nlabels, np.nan)
+    for t in range(mask.shape[0]):
+        mask_t = np.asarray(mask[t]).astype(np.intp, copy=False)
+        values_t = np.asarray(values[t])
+        areas += np.bincount(mask_t.ravel(), minlength=nlabels)
+        inside = mask_t > 0
+        # fmax skips NaNs, and leaves NaN only if all values are NaN
+        np.fmax.at(maxima, mask_t[inside], values_t[inside])
+    maxima[areas == 0] = 0.0
+    return areas, maxima
+
+
+def _masked_column_max(refl, rhv):
+    # Max over the z axis, skipping points with both rhv < 0.9 and refl < 10
+    # (and missing refl) in a single pass; all-skipped columns become NaN
+    skip = ((rhv < 0.9) & (refl < 10)) | np.isnan(refl)
+    col_max = np.where(skip, -np.inf, refl).max(axis=-3)
+    col_max[col_max == -np.inf] = np.nan
+    return col_max
+
+
+def column_max_reflectivity(refl, rhv):
+    """
+    Column maximum of refl, ignoring points where rhv < 0.9 and refl < 10.
+
+    Equivalent to refl.where(~((rhv < 0.9) & (refl < 10))).max(axis=1), but
+    computed in one pass per time block without the NaN-filled intermediate.
+
+    Parameters
+    ----------
+    refl, rhv : xarray.DataArray
+        Reflectivity and correlation coefficient with the same dims, in the
+        order (time, z, y, x); the dims may have any names.
+
+    Returns
+    -------
+    maxrefl : xarray.DataArray
+        Column maximum reflectivity, with the second (vertical) dim removed.
+
+    """
+    # Reduce over the second dim, as max(axis=1) does, whatever it is named.
+    # Core dims must each be one dask chunk, but files chunked on disk per
+    # level open with several chunks along z, so merge them per time block.
+    core_dims = list(refl.dims[1:])
+    if refl.chunks is not None:
+        refl = refl.chunk({d: -1 for d in core_dims})
+    if rhv.chunks is not None:
+        rhv = rhv.chunk({d: -1 for d in core_dims})
+    return xr.apply_ufunc(
+        _masked_column_max,
+        refl,
+        rhv,
+        input_core_dims=[core_dims, core_dims],
+        output_core_dims=[core_dims[1:]],
+        dask="parallelized",
+        output_dtypes=[refl.dtype],
+    )
+
+
 def compress_all(nc_grids, min_dims=2, comp_level=4):
     """
     The purpose of this subroutine is to compress the netcdf variables as they are saved.
@@ -440,6 +558,9 @@ def compress_all(nc_grids, min_dims=2, comp_level=4):
     """
 
     for var in nc_grids:
+        # netCDF does not deflate variable-length strings; some versions raise
+        if nc_grids[var].dtype.kind in "OSU":
+            continue
         if len(nc_grids[var].dims) >= min_dims:
             # print("Compressing ", var)
             nc_grids[var].encoding["zlib"] = True
@@ -468,12 +589,12 @@ if __name__ == '__main__':
     #NEXRAD
     if args.data_type == 'NEXRAD':
     
-        data = xarray.open_mfdataset(args.path+"*.nc", engine="netcdf4")
+        data = xarray.open_mfdataset(args.path+"*.nc", engine="netcdf4", parallel=True,
+                                     chunks={"time": 1})
         data['time'].encoding['units']="seconds since 2000-01-01 00:00:00"
-        bad_rhv = data["cross_correlation_ratio"] < 0.9
-        bad_refl = data["reflectivity"] < 10
-        bad=bad_rhv & bad_refl
-        maxrefl = data["reflectivity"].where(~bad, np.nan).max(axis=1)
+        # float32 is plenty for dBZ and halves the memory traffic of the reduction
+        maxrefl = column_max_reflectivity(data["reflectivity"].astype(np.float32),
+                                          data["cross_correlation_ratio"].astype(np.float32))
 
         ts = pd.to_datetime(data['time'][0].values)
         date = ts.strftime('%Y%m%d')
@@ -491,12 +612,10 @@ if __name__ == '__main__':
 
         
 # #HORIZONTAL GRID RESOLUTION, AND TIME RESOLUTION
-        datetimes = data["time"]
-        timedeltas = [(datetimes[i - 1] - datetimes[i]).astype("timedelta64[m]")for i in range(1, len(datetimes))]
-        average_timedelta = sum(timedeltas) / len(timedeltas)
-        dt = np.abs(np.array(average_timedelta)).astype("timedelta64[m]").astype(int)
-        deltax = [data["x"][i - 1] - data["x"][i] for i in range(1, len(data["x"]))]
-        dxy = np.abs(np.mean(deltax).astype(int)) / 1000.
+        # Steps are earlier minus later time, floored to whole minutes
+        timedeltas = (-np.diff(data["time"].values)).astype("timedelta64[m]").astype(int)
+        dt = np.abs(timedeltas.mean()).astype(int)
+        dxy = np.abs(np.diff(data["x"].values).mean().astype(int)) / 1000.
 
 
         
@@ -557,30 +676,23 @@ if __name__ == '__main__':
         
     if args.data_type == 'POLARRIS':
     
-        data = xr.open_mfdataset(args.path+'*.nc', engine = 'netcdf4',combine = 'nested' ,concat_dim='time')
-        data['time'].encoding['units']="seconds since 2000-01-01 00:00:00"
         files = sorted(glob(args.path+'*.nc'))
-        arr = []
-        for i in files:
-            arr.append(pd.to_datetime(i[-19:-3], format = '%Y_%m%d_%H%M%S'))
-        arr = pd.DatetimeIndex(arr)
+        data = xr.open_mfdataset(files, engine = 'netcdf4',combine = 'nested' ,concat_dim='time',
+                                 parallel=True, chunks={"time": 1})
+        data['time'].encoding['units']="seconds since 2000-01-01 00:00:00"
+        arr = pd.to_datetime([os.path.basename(f)[-19:-3] for f in files], format = '%Y_%m%d_%H%M%S')
         data = data.assign_coords(time=arr)
 
 
-        bad_rhv = data["RH"] < 0.9
-        bad_refl = data["CZ"] < 10
-        bad=bad_rhv & bad_refl
-        maxrefl = data["CZ"].where(~bad, np.nan).max(axis=1)
+        maxrefl = column_max_reflectivity(data["CZ"].astype(np.float32), data["RH"].astype(np.float32))
 
     
 
         #Dt, DXY
-        datetimes = data['time']
-        timedeltas = [(datetimes[i-1]-datetimes[i]).astype('timedelta64[m]') for i in range(1, len(datetimes))]
-        average_timedelta = sum(timedeltas) / len(timedeltas)
-        dt = np.abs(np.array(average_timedelta)).astype('timedelta64[m]').astype(int)
-        deltax = [data['x'][i-1]-data['x'][i] for i in range(1, len(data['x']))]
-        dxy = np.abs(np.mean(deltax).astype(int))/1000
+        # Steps are earlier minus later time, floored to whole minutes
+        timedeltas = (-np.diff(data['time'].values)).astype('timedelta64[m]').astype(int)
+        dt = np.abs(timedeltas.mean()).astype(int)
+        dxy = np.abs(np.diff(data['x'].values).mean().astype(int))/1000
 
 
         ts = pd.to_datetime(data['time'][0].values)
@@ -596,12 +708,16 @@ if __name__ == '__main__':
             os.makedirs(plot_dir)
 
 
+    # Evaluate the column max once; feature detection, segmentation and the
+    # per-feature statistics all reuse it
+    maxrefl = maxrefl.compute()
+
     if args.Gauss_Smooth == True:
         print("Gausian Smoothing is enabled on maxrefl Data")
         #STEP TO SMOOTH REFLECTIVITY. The Kernel size along each axis is 2*radius + 1 
         from scipy.ndimage import gaussian_filter
         maxrefl.shape
-        blurr_maxrefl = np.zeros(maxrefl.shape)
+        blurr_maxrefl = np.zeros(maxrefl.shape, dtype=maxrefl.dtype)
         blurr_maxrefl.shape
         for i,times in enumerate(maxrefl['time'].values):
             blurr_maxrefl[i,:,:] = gaussian_filter(maxrefl[i,:,:],1,radius = 2)
@@ -630,8 +746,6 @@ if __name__ == '__main__':
     Features_iris = tobac.feature_detection_multithreshold(maxrefl_iris, dxy, **parameters_features)
     Features = Features_iris.to_xarray()
     print("feature detection done")
-    Features.to_netcdf(os.path.join(savedir, "Features.nc"))
-    print("features saved")
 
 
 
@@ -659,22 +773,13 @@ if __name__ == '__main__':
 
     # Mask,Features_Precip=segmentation(Features,maxrefl,dxy,**parameters_segmentation)
     print("segmentation based on reflectivity performed, start saving results to files")
-    Mask.to_netcdf(os.path.join(savedir, "Mask_Segmentation_refl.nc"))
+    compress_all(Mask).to_netcdf(os.path.join(savedir, "Mask_Segmentation_refl.nc"))
     print("segmentation reflectivity performed and saved")
 
 
-    areas = np.zeros([(len(Features["index"]) + 1)])
-    maxfeature_refl = np.zeros([(len(Features["index"]) + 1)])
     # Mask = Mask.to_dataset()
-    frame_features = Features.groupby("frame")
-
-    for frame_i, features_i in frame_features:
-        mask_i = Mask["segmentation_mask"][frame_i, :, :].values
-        subrefl = maxrefl[frame_i, :, :].values
-        for i in np.unique(mask_i):
-            feature_area_i = np.where(mask_i == i)
-            areas[i] = len(feature_area_i[0])
-            maxfeature_refl[i] = np.nanmax(subrefl[feature_area_i])
+    nlabels = len(Features["index"]) + 1
+    areas, maxfeature_refl = feature_area_and_max(Mask["segmentation_mask"], maxrefl, nlabels)
             
     var = Features["feature"].copy(data=areas[1:])
     var = var.rename("areas")
@@ -687,14 +792,8 @@ if __name__ == '__main__':
         print('extra variables, finding the max for each feature')
         for i in args.add_var:
             print(i)
-            iarr = np.zeros([(len(Features["index"]) + 1)])
             maxi = data[str(i)].max(axis=1)
-            for frame_i, features_i in frame_features:
-                mask_i = Mask["segmentation_mask"][frame_i, :, :].values
-                submaxi = maxi[frame_i, :, :].values
-                for j in np.unique(mask_i):
-                    feature_area_i = np.where(mask_i == j)
-                    iarr[j] = np.nanmax(submaxi[feature_area_i])
+            _, iarr = feature_area_and_max(Mask["segmentation_mask"], maxi, nlabels)
 
             var_max = Features["feature"].copy(data=iarr[1:])
             var_max = var_max.rename("max_"+str(i))
@@ -702,9 +801,7 @@ if __name__ == '__main__':
 
     	
 
-    Features.to_netcdf(os.path.join(savedir, "Features.nc"))
-    Mask = Mask.to_array()
-    Features_df = Features.to_dataframe()
+    compress_all(Features, min_dims=1).to_netcdf(os.path.join(savedir, "Features.nc"))
     print("features saved")
 
 
@@ -713,23 +810,21 @@ if __name__ == '__main__':
     Features_df = Features.to_dataframe()
     Track = tobac.linking_trackpy(Features_df, Mask_iris, dt=dt, dxy=dxy, **parameters_linking)
     #(type(Track))
-    Track = Track.to_xarray()
-    Track.to_netcdf(os.path.join(savedir, "Track.nc"))
+    # Keep the linked DataFrame in memory for merge_split instead of reading
+    # Track.nc back; the xarray version is what gets saved and standardized
+    Track_ds = Track.to_xarray()
+    compress_all(Track_ds, min_dims=1).to_netcdf(os.path.join(savedir, "Track.nc"))
 
-    Track = xarray.open_dataset(savedir + "/Track.nc")
-    Track = Track.to_dataframe()
-    Features = xarray.open_dataset(savedir + "/Features.nc")
-    refl_mask = xarray.open_dataset(savedir + "/Mask_Segmentation_refl.nc")
 #Track=tobac.themes.tobac_v1.linking_trackpy(Features,Mask,dt=dt,dxy=dxy,**parameters_linking)
 
 
     print("starting merge_split")
 
     d = merge_split_MEST(Track,dxy*1000., distance=15000.0)  # , dxy = dxy)
-    Track = xarray.open_dataset(savedir + "/Track.nc")
+    Track = Track_ds
     if args.data_type =='NUWRF':
         Track = Track.rename_vars({'XLAT':'wrf_XLAT', 'XLONG':'wrf_XLONG'})
-    ds = standardize_track_dataset(Track, refl_mask)
+    ds = standardize_track_dataset(Track, Mask)
     both_ds = xarray.merge([ds, d], compat="override")
 
     both_ds = count_track_neighbors(both_ds, grid_spacing=dxy)